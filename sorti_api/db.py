@@ -1,9 +1,16 @@
 from __future__ import annotations
 
+import abc
+import contextlib
+import functools
 import os
+import queue
 import sqlite3
+import threading
+import time
+import uuid
 from pathlib import Path
-from typing import Any, Optional, Sequence
+from typing import Any, Final, Iterable, Iterator, Sequence
 
 # Struttura: sorti_api/
 #   - db.py  <-- questo file
@@ -16,31 +23,226 @@ SQLITE_PATH = DATA_DIR / "sorti.db"
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
 USE_POSTGRES = bool(DATABASE_URL)
 
+# Pool connessioni: aperte una volta per processo, riusate dalle request
+# SQLite: lettori quanti i core, più una sola connessione dedicata alle scritture
+SQLITE_POOL_SIZE = int(os.getenv("SORTI_SQLITE_POOL_SIZE", str(os.cpu_count() or 4)))
+PG_POOL_MIN = int(os.getenv("SORTI_PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("SORTI_PG_POOL_MAX", "10"))
+# attesa massima di una connessione per il healthcheck
+PG_HEALTH_TIMEOUT_S = 2.0
+# attesa massima di una connessione libera (entrambi i backend): poi DBBusyError (-> 503)
+DB_POOL_TIMEOUT_S = float(os.getenv("SORTI_DB_POOL_TIMEOUT_S", "10"))
+# export CSV in streaming contemporanei; su SQLite hanno un pool proprio di questa dimensione
+EXPORT_MAX_CONCURRENT = int(os.getenv("SORTI_EXPORT_MAX_CONCURRENT", "2"))
+
+# statement preparati tenuti in cache da ogni connessione SQLite (default sqlite3: 128)
+SQLITE_CACHED_STATEMENTS = 256
+
+# righe per executemany su Postgres (psycopg le invia in pipeline)
+EXECUTEMANY_BATCH = 50
+
+# righe per blocco nelle letture in streaming (export)
+STREAM_ITERSIZE = 1000
+
+# parametri vuoti condivisi: niente lista nuova per ogni query senza parametri
+_EMPTY: tuple = ()
+
+# PRAGMA per-connessione (journal_mode=WAL invece è persistente nel file DB)
+_SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+)
+
+
+# Macro SQL per i timestamp lato DB (e le poche espressioni che differiscono tra i backend).
+# events.ts è TIMESTAMPTZ su Postgres e TEXT ISO-8601 UTC su SQLite;
+# bins.last_seen è TEXT ISO-8601 UTC su entrambi (stesso formato di datetime.isoformat()).
+#   :NOW_TS      -> istante corrente, per events.ts
+#   :CUTOFF_TS   -> inizio (00:00 UTC) del giorno :CUTOFF_DAY, confrontabile con events.ts
+#                   (consuma un parametro): stessa finestra a giorni interi di events_daily
+#   :TS_DAY      -> giorno UTC 'YYYY-MM-DD' di events.ts
+#   :NOW         -> istante corrente come testo ISO, per le colonne TEXT
+#   :CUTOFF_DAY  -> giorno UTC 'YYYY-MM-DD' di (adesso - ? giorni), per events_daily.day (consuma un parametro)
+#   :TS_ISO      -> events.ts come testo ISO-8601 UTC (per export senza conversioni in Python)
+#   :FILL_PERCENT -> riempimento % del bin (0 se capacity_g <= 0, max 100), su righe di bins;
+#                   * 100.0 prima della divisione: mai divisione intera su SQLite
+_SQLITE_MACROS = {
+    ":FILL_PERCENT": "CASE WHEN capacity_g <= 0 THEN 0.0 "
+                     "ELSE MIN(100.0, current_weight_g * 100.0 / capacity_g) END",
+    ":CUTOFF_TS": "strftime('%Y-%m-%dT00:00:00+00:00', 'now', '-' || ? || ' days')",
+    ":TS_DAY": "substr(ts, 1, 10)",
+    ":CUTOFF_DAY": "strftime('%Y-%m-%d', 'now', '-' || ? || ' days')",
+    ":TS_ISO": "ts",
+    ":NOW_TS": "strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')",
+    ":NOW": "strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')",
+}
+_PG_MACROS = {
+    ":FILL_PERCENT": "CASE WHEN capacity_g <= 0 THEN 0.0 "
+                     "ELSE LEAST(100.0, current_weight_g * 100.0 / capacity_g) END",
+    ":CUTOFF_TS": "(date_trunc('day', (NOW() - (? * INTERVAL '1 day')) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC')",
+    ":TS_DAY": "to_char(ts AT TIME ZONE 'UTC', 'YYYY-MM-DD')",
+    ":CUTOFF_DAY": "to_char((NOW() - (? * INTERVAL '1 day')) AT TIME ZONE 'UTC', 'YYYY-MM-DD')",
+    ":TS_ISO": "to_char(ts AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS.US\"+00:00\"')",
+    ":NOW_TS": "NOW()",
+    ":NOW": "to_char(NOW() AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS.US\"+00:00\"')",
+}
+
+
+def _expand_macros(sql: str, macros: dict[str, str]) -> str:
+    if ":" not in sql:
+        return sql
+    for name, expr in macros.items():
+        sql = sql.replace(name, expr)
+    return sql
+
+
+@functools.lru_cache(maxsize=256)
+def _translate_sql_for_sqlite(sql: str) -> str:
+    return _expand_macros(sql, _SQLITE_MACROS)
+
 
 def _qmarks_to_psycopg(sql: str) -> str:
     return sql.replace("?", "%s")
 
 
-def _rewrite_daily_sql(sql: str) -> str:
-    # riscrive SOLO la query "daily" quando siamo su Postgres
-    if "substr(ts, 1, 10) AS day" in sql and "datetime('now'" in sql:
-        return """
-            SELECT
-              to_char(ts::timestamptz, 'YYYY-MM-DD') AS day,
-              COALESCE(SUM(weight_g), 0) AS weight_g,
-              COALESCE(SUM(co2_saved_g), 0) AS co2_saved_g
-            FROM events
-            WHERE ts::timestamptz >= NOW() - (%s * INTERVAL '1 day')
-            GROUP BY to_char(ts::timestamptz, 'YYYY-MM-DD')
-            ORDER BY day ASC
-        """.strip()
-    return sql
+@functools.lru_cache(maxsize=256)
+def _translate_sql_for_postgres(sql: str) -> str:
+    # le query arrivano da literal di main.py: la traduzione si paga una volta sola
+    return _qmarks_to_psycopg(_expand_macros(sql, _PG_MACROS))
+
+
+class DBBusyError(Exception):
+    # nessuna connessione libera entro DB_POOL_TIMEOUT_S: l'app risponde 503
+    pass
+
+
+class _SqlitePool:
+    # pool minimale basato su queue.LifoQueue: le connessioni vengono create
+    # lazy fino a `size`, poi si aspetta che una venga restituita.
+    # LIFO: si riusa l'ultima restituita, quella con la page cache più calda
+    def __init__(self, size: int, query_only: bool = False):
+        self._q: queue.LifoQueue = queue.LifoQueue()
+        self._size = max(1, size)
+        self._query_only = query_only
+        self._created = 0
+        self._lock = threading.Lock()
+        self._wal_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # assicura che la cartella data/ esista anche su ambienti "fresh"
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+        conn = sqlite3.connect(
+            SQLITE_PATH,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+        )
+        conn.row_factory = sqlite3.Row
+
+        # WAL: commit senza fsync sul writer lock, letture concorrenti alle scritture
+        if not self._wal_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._wal_ready = True
+        for pragma in _SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        # pool dei lettori (export, dashboard): una scrittura finita qui per errore fallisce
+        # subito invece di prendere il lock del file in concorrenza col writer
+        if self._query_only:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def getconn(self) -> sqlite3.Connection:
+        try:
+            return self._q.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self._size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._q.get(timeout=DB_POOL_TIMEOUT_S)
+        except queue.Empty:
+            raise DBBusyError("Nessuna connessione SQLite libera") from None
+
+    def putconn(self, conn: sqlite3.Connection) -> None:
+        self._q.put(conn)
+
+    def close(self) -> None:
+        # chiude le connessioni idle; quelle in uso restano a chi le ha prese
+        while True:
+            try:
+                conn = self._q.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+@functools.lru_cache(maxsize=1)
+def _sqlite_pool() -> _SqlitePool:
+    return _SqlitePool(SQLITE_POOL_SIZE, query_only=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _sqlite_writer_pool() -> _SqlitePool:
+    # SQLite ammette un solo writer alla volta: le scritture si mettono in coda qui
+    # invece di contendersi il lock del file nel busy handler
+    return _SqlitePool(1)
+
+
+@functools.lru_cache(maxsize=1)
+def _sqlite_export_pool() -> _SqlitePool:
+    # export in streaming: un download lento tiene la connessione per tutta la durata,
+    # fuori dai lettori non toglie connessioni a dashboard e ingest
+    return _SqlitePool(EXPORT_MAX_CONCURRENT, query_only=True)
+
 
+@functools.lru_cache(maxsize=1)
+def _sqlite_health_conn() -> sqlite3.Connection:
+    # connessione dedicata all'healthcheck, sempre aperta (fuori dal pool)
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    return sqlite3.connect(SQLITE_PATH, check_same_thread=False)
 
-class DBConn:
-    def __init__(self, backend: str, raw: Any):
-        self.backend = backend
+
+_health_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _pg_pool():
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
+    return ConnectionPool(
+        DATABASE_URL,
+        min_size=PG_POOL_MIN,
+        max_size=PG_POOL_MAX,
+        # prepare_threshold=1: le poche query ripetute vengono preparate
+        # lato server già dalla seconda esecuzione
+        kwargs={"row_factory": dict_row, "prepare_threshold": 1},
+        open=True,
+    )
+
+
+class DBConn(abc.ABC):
+    # base comune: transazione + ritorno al pool. Le sottoclassi sono scelte
+    # una volta in get_conn(), così execute() non ha branch sul backend.
+    # Metodi astratti: un override mancante fallisce all'istanziazione, non a metà richiesta
+    backend = ""
+
+    def __init__(self, raw: Any, pool: Any, readonly: bool = False):
         self.raw = raw
+        self._pool = pool
+        self.readonly = readonly
         self._closed = False
 
     def __enter__(self) -> "DBConn":
@@ -48,7 +250,10 @@ class DBConn:
 
     def __exit__(self, exc_type, exc, tb) -> None:
         try:
-            if exc_type is None:
+            # readonly: nessuna transazione aperta, niente COMMIT/ROLLBACK da inviare
+            if self.readonly:
+                pass
+            elif exc_type is None:
                 self.raw.commit()
             else:
                 self.raw.rollback()
@@ -56,115 +261,486 @@ class DBConn:
             self.close()
 
     def close(self) -> None:
+        # non chiude davvero: restituisce la connessione al pool
+        # putconn anche se _release fallisce: altrimenti la connessione esce dal pool per sempre
         if not self._closed:
+            self._closed = True
             try:
-                self.raw.close()
+                self._release()
             finally:
-                self._closed = True
+                self._pool.putconn(self.raw)
 
-    def execute(self, sql: str, params: Optional[Sequence[Any]] = None):
-        if params is None:
-            params = []
+    def _release(self) -> None:
+        pass
 
-        if self.backend == "sqlite":
-            return self.raw.execute(sql, params)
+    @abc.abstractmethod
+    def execute(self, sql: str, params: Sequence[Any] = _EMPTY):
+        raise NotImplementedError
 
-        sql_pg = _rewrite_daily_sql(_qmarks_to_psycopg(sql))
-        cur = self.raw.cursor()
-        cur.execute(sql_pg, params)
-        return cur
+    @abc.abstractmethod
+    def fetch_tuples(self, sql: str, params: Sequence[Any] = _EMPTY) -> list[tuple]:
+        # tutte le righe come tuple semplici, nell'ordine delle colonne della SELECT:
+        # per i loop che spacchettano le righe invece di cercare le colonne per nome
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stream(self, sql: str, params: Sequence[Any] = _EMPTY, tuples: bool = False) -> Iterator[Any]:
+        # letture grandi riga per riga, senza materializzare tutto il result set.
+        # tuples=True: righe come tuple semplici (es. direttamente a csv.writer.writerows)
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def executescript(self, script: str) -> None:
+        # più statement senza parametri in un solo invio (DDL di init_db)
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def read_snapshot(self) -> Iterator[None]:
+        # più SELECT di sola lettura sulla stessa istantanea (solo connessioni readonly).
+        # Base: nessuna transazione esplicita; Postgres readonly resta in autocommit
+        # per non pagare BEGIN/COMMIT in round-trip
+        yield
 
+    @abc.abstractmethod
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> None:
+        # insert multi-riga: un solo statement preparato per tutto il batch
+        raise NotImplementedError
 
-def get_conn() -> DBConn:
+
+class _SqliteConn(DBConn):
+    backend = "sqlite"
+
+    def execute(self, sql: str, params: Sequence[Any] = _EMPTY):
+        return self.raw.execute(_translate_sql_for_sqlite(sql), params)
+
+    def fetch_tuples(self, sql: str, params: Sequence[Any] = _EMPTY) -> list[tuple]:
+        cur = self.raw.cursor()
+        cur.row_factory = None
+        return cur.execute(_translate_sql_for_sqlite(sql), params).fetchall()
+
+    def stream(self, sql: str, params: Sequence[Any] = _EMPTY, tuples: bool = False) -> Iterator[Any]:
+        cur = self.raw.cursor()
+        if tuples:
+            cur.row_factory = None
+        cur.execute(_translate_sql_for_sqlite(sql), params)
+        while True:
+            rows = cur.fetchmany(STREAM_ITERSIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def executescript(self, script: str) -> None:
+        self.raw.executescript(script)
+
+    @contextlib.contextmanager
+    def read_snapshot(self) -> Iterator[None]:
+        # una sola transazione di lettura: le SELECT condividono lo snapshot WAL invece
+        # di aprirne e chiuderne uno ciascuna (niente round-trip: è tutto in-process)
+        self.raw.execute("BEGIN")
+        try:
+            yield
+        finally:
+            # chiusa sempre: uno snapshot aperto bloccherebbe il checkpoint del WAL
+            self.raw.commit()
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> None:
+        self.raw.executemany(_translate_sql_for_sqlite(sql), seq_of_params)
+
+
+class _PgConn(DBConn):
+    backend = "postgres"
+
+    def __init__(self, raw: Any, pool: Any, readonly: bool = False):
+        super().__init__(raw, pool, readonly)
+        self._cur: Any = None
+        if readonly:
+            # autocommit: psycopg non apre la transazione implicita (niente BEGIN/COMMIT)
+            raw.autocommit = True
+
+    def _release(self) -> None:
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+        if self.readonly:
+            self.raw.autocommit = False
+
+    def execute(self, sql: str, params: Sequence[Any] = _EMPTY):
+        # un solo cursore per DBConn: ogni risultato viene letto prima della query successiva
+        sql_pg = _translate_sql_for_postgres(sql)
+        if self._cur is None:
+            self._cur = self.raw.cursor()
+        self._cur.execute(sql_pg, params)
+        return self._cur
+
+    def fetch_tuples(self, sql: str, params: Sequence[Any] = _EMPTY) -> list[tuple]:
+        from psycopg.rows import tuple_row
+
+        # cursore client-side dedicato: nessun round-trip in più, il cursore dict resta com'è
+        with self.raw.cursor(row_factory=tuple_row) as cur:
+            cur.execute(_translate_sql_for_postgres(sql), params)
+            return cur.fetchall()
+
+    def stream(self, sql: str, params: Sequence[Any] = _EMPTY, tuples: bool = False) -> Iterator[Any]:
+        # cursore server-side (named) in binario, a blocchi di itersize
+        from psycopg.rows import dict_row, tuple_row
+
+        sql_pg = _translate_sql_for_postgres(sql)
+        row_factory = tuple_row if tuples else dict_row
+        # il cursore named vive in una transazione: in autocommit (readonly) la apre qui
+        with self.raw.transaction():
+            with self.raw.cursor(name=f"c_{uuid.uuid4().hex}", binary=True, row_factory=row_factory) as cur:
+                cur.itersize = STREAM_ITERSIZE
+                cur.execute(sql_pg, params)
+                yield from cur
+
+    def executescript(self, script: str) -> None:
+        # senza parametri psycopg usa il simple query protocol: multi-statement ok
+        with self.raw.cursor() as cur:
+            cur.execute(script)
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> None:
+        sql_pg = _translate_sql_for_postgres(sql)
+        batch: list[Sequence[Any]] = []
+        with self.raw.cursor() as cur:
+            for params in seq_of_params:
+                batch.append(params)
+                if len(batch) >= EXECUTEMANY_BATCH:
+                    cur.executemany(sql_pg, batch)
+                    batch = []
+            if batch:
+                cur.executemany(sql_pg, batch)
+
+
+def ping() -> None:
+    # healthcheck: gli errori arrivano all'handler di /health (-> 500)
     if not USE_POSTGRES:
-        # assicura che la cartella data/ esista anche su ambienti "fresh"
-        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        # SQLite: connessione dedicata, niente checkout dal pool
+        conn = _sqlite_health_conn()
+        with _health_lock:
+            conn.execute("SELECT 1").fetchone()
+        return
 
-        conn = sqlite3.connect(SQLITE_PATH)
-        conn.row_factory = sqlite3.Row
-        return DBConn("sqlite", conn)
+    # Postgres: SELECT 1 vero su una connessione del pool (pool.check() non solleva
+    # se il server è giù); pool esaurito o server irraggiungibile -> PoolTimeout
+    with _pg_pool().connection(timeout=PG_HEALTH_TIMEOUT_S) as conn:
+        conn.execute("SELECT 1").fetchone()
 
-    import psycopg
-    from psycopg.rows import dict_row
-    conn = psycopg.connect(DATABASE_URL, row_factory=dict_row)
-    return DBConn("postgres", conn)
 
+def get_conn(readonly: bool = False) -> DBConn:
+    # readonly=True per gli endpoint di sola lettura: su Postgres risparmia un round-trip
+    if not USE_POSTGRES:
+        pool = _sqlite_pool() if readonly else _sqlite_writer_pool()
+        return _SqliteConn(pool.getconn(), pool, readonly)
 
-def _sqlite_add_column_if_missing(conn: DBConn, table: str, col: str, coltype: str) -> None:
-    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
-    existing = {r["name"] for r in rows}
-    if col not in existing:
-        conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coltype}")
+    return _PgConn(_pg_getconn(), _pg_pool(), readonly)
 
 
-def _pg_add_column_if_missing(conn: DBConn, table: str, col: str, coltype: str) -> None:
-    conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col} {coltype}")
+def get_export_conn() -> DBConn:
+    # connessione readonly per gli export in streaming. SQLite: pool dedicato;
+    # Postgres: pool condiviso, il numero di export è limitato dall'app
+    if not USE_POSTGRES:
+        pool = _sqlite_export_pool()
+        return _SqliteConn(pool.getconn(), pool, True)
+
+    return _PgConn(_pg_getconn(), _pg_pool(), True)
+
+
+def _pg_getconn() -> Any:
+    from psycopg_pool import PoolTimeout
+
+    try:
+        return _pg_pool().getconn(timeout=DB_POOL_TIMEOUT_S)
+    except PoolTimeout:
+        raise DBBusyError("Nessuna connessione Postgres libera") from None
+
+
+def close_pools() -> None:
+    # shutdown: chiude solo i pool già creati (lru_cache) e li azzera, così un
+    # get_conn() successivo riparte da pool nuovi. SQLite: l'ultima connessione
+    # chiusa fa il checkpoint del WAL
+    if _pg_pool.cache_info().currsize:
+        _pg_pool().close()
+    for pool_fn in (_sqlite_pool, _sqlite_writer_pool, _sqlite_export_pool):
+        if pool_fn.cache_info().currsize:
+            pool_fn().close()
+    if _sqlite_health_conn.cache_info().currsize:
+        with _health_lock:
+            _sqlite_health_conn().close()
+    for fn in (_pg_pool, _sqlite_pool, _sqlite_writer_pool, _sqlite_export_pool, _sqlite_health_conn):
+        fn.cache_clear()
+
+
+# Migrazioni colonne SQLite: (colonna, tipo) per tabella
+_SQLITE_MIGRATIONS: dict[str, tuple[tuple[str, str], ...]] = {
+    # Step 12: bins.ingest_key
+    "bins": (
+        ("ingest_key", "TEXT"),
+    ),
+    # Step 10: eventi AI-ready
+    "events": (
+        ("source", "TEXT"),
+        ("model_version", "TEXT"),
+        ("confidence", "REAL"),
+        ("topk_json", "TEXT"),
+        ("image_ref", "TEXT"),
+    ),
+}
+
+
+def _sqlite_existing_columns(conn: DBConn, table: str) -> set[str]:
+    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    return {r["name"] for r in rows}
+
+
+def _sqlite_migrate_columns(conn: DBConn) -> None:
+    # un solo PRAGMA table_info per tabella, non uno per colonna
+    for table, columns in _SQLITE_MIGRATIONS.items():
+        existing = _sqlite_existing_columns(conn, table)
+        for col, coltype in columns:
+            if col not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coltype}")
+
+
+@contextlib.contextmanager
+def _pg_migration_lock() -> Iterator[None]:
+    # advisory lock di sessione: worker avviati insieme eseguono init_db uno alla volta.
+    # La connessione che lo tiene resta idle in autocommit (nessuna transazione aperta che
+    # CREATE INDEX CONCURRENTLY debba aspettare); try-lock a polling perché un'attesa
+    # bloccante sarebbe una transazione aperta e andrebbe in deadlock con quella build
+    pool = _pg_pool()
+    raw = pool.getconn()
+    try:
+        raw.autocommit = True
+        while not raw.execute("SELECT pg_try_advisory_lock(%s) AS ok", (_PG_MIGRATION_LOCK_KEY,)).fetchone()["ok"]:
+            time.sleep(PG_MIGRATION_LOCK_POLL_S)
+        try:
+            yield
+        finally:
+            raw.execute("SELECT pg_advisory_unlock(%s)", (_PG_MIGRATION_LOCK_KEY,))
+    finally:
+        raw.autocommit = False
+        pool.putconn(raw)
+
+
+def _pg_sync_indexes() -> None:
+    # DDL CONCURRENTLY in autocommit, uno statement alla volta, solo per gli indici
+    # mancanti o non validi: a regime (indici già a posto) nessun DDL all'avvio
+    pool = _pg_pool()
+    raw = pool.getconn()
+    try:
+        raw.autocommit = True
+        names = [name for name, _ in _PG_INDEXES] + list(_PG_DROPPED_INDEXES)
+        valid = {
+            r["relname"]: r["indisvalid"]
+            for r in raw.execute("""
+                SELECT c.relname, i.indisvalid
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = current_schema() AND c.relname = ANY(%s)
+            """, (names,)).fetchall()
+        }
+        for name, ddl in _PG_INDEXES:
+            if valid.get(name):
+                continue
+            # build CONCURRENTLY interrotta: resta un indice INVALID che
+            # IF NOT EXISTS salterebbe per sempre, va eliminato e ricostruito
+            if name in valid:
+                raw.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            raw.execute(ddl)
+        for name in _PG_DROPPED_INDEXES:
+            if name in valid:
+                raw.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    finally:
+        raw.autocommit = False
+        pool.putconn(raw)
+
+
+# =========================
+# DDL (costanti di modulo: init_db sceglie lo script per backend)
+# =========================
+
+# SQLite: tabelle base + indici
+_DDL_SQLITE: Final = """
+CREATE TABLE IF NOT EXISTS bins (
+    bin_id TEXT PRIMARY KEY,
+    capacity_g REAL NOT NULL DEFAULT 10000,
+    current_weight_g REAL NOT NULL DEFAULT 0,
+    last_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts TEXT NOT NULL,
+    bin_id TEXT NOT NULL,
+    material TEXT NOT NULL,
+    weight_g REAL NOT NULL,
+    co2_saved_g REAL NOT NULL,
+    FOREIGN KEY(bin_id) REFERENCES bins(bin_id)
+);
+
+-- Aggregato giornaliero per bin, aggiornato da add_event nella stessa transazione
+CREATE TABLE IF NOT EXISTS events_daily (
+    day TEXT NOT NULL,
+    bin_id TEXT NOT NULL,
+    weight_g REAL NOT NULL DEFAULT 0,
+    co2_saved_g REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY(day, bin_id)
+) WITHOUT ROWID;
+
+-- Totali per materiale (tutto lo storico), aggiornati come events_daily
+CREATE TABLE IF NOT EXISTS events_material (
+    material TEXT PRIMARY KEY,
+    weight_g REAL NOT NULL DEFAULT 0,
+    co2_saved_g REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- Indici: scan ordinato su ts covering per l'export CSV (sostituisce idx_events_ts,
+-- usato solo da quello) e range (bin_id, ts) covering per il report per materiale
+-- di un bin (sostituisce il vecchio idx_events_bin_ts)
+DROP INDEX IF EXISTS idx_events_ts;
+CREATE INDEX IF NOT EXISTS idx_events_ts_cov ON events(ts, bin_id, material, weight_g, co2_saved_g);
+DROP INDEX IF EXISTS idx_events_bin_ts;
+CREATE INDEX IF NOT EXISTS idx_events_bin_ts_cov ON events(bin_id, ts, material, weight_g, co2_saved_g);
+-- (bin_id, id) per gli ultimi eventi di un bin. idx_events_material non serve più:
+-- il GROUP BY material globale legge events_material
+DROP INDEX IF EXISTS idx_events_material;
+CREATE INDEX IF NOT EXISTS idx_events_bin_id ON events(bin_id, id);
+"""
+
+# Statistiche per il planner dopo tabelle/indici/migrazioni. analysis_limit: ANALYZE
+# approssimato (righe campionate per indice), veloce all'avvio anche con storico grande
+_ANALYZE_SQLITE: Final = """
+PRAGMA analysis_limit=400;
+ANALYZE;
+"""
+
+# Postgres: tabelle base + migrazioni, un unico round-trip
+_DDL_PG: Final = """
+CREATE TABLE IF NOT EXISTS bins (
+    bin_id TEXT PRIMARY KEY,
+    capacity_g DOUBLE PRECISION NOT NULL DEFAULT 10000,
+    current_weight_g DOUBLE PRECISION NOT NULL DEFAULT 0,
+    last_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id BIGSERIAL PRIMARY KEY,
+    ts TIMESTAMPTZ NOT NULL,
+    bin_id TEXT NOT NULL REFERENCES bins(bin_id),
+    material TEXT NOT NULL,
+    weight_g DOUBLE PRECISION NOT NULL,
+    co2_saved_g DOUBLE PRECISION NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events_daily (
+    day TEXT NOT NULL,
+    bin_id TEXT NOT NULL,
+    weight_g DOUBLE PRECISION NOT NULL DEFAULT 0,
+    co2_saved_g DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY(day, bin_id)
+);
+CREATE TABLE IF NOT EXISTS events_material (
+    material TEXT PRIMARY KEY,
+    weight_g DOUBLE PRECISION NOT NULL DEFAULT 0,
+    co2_saved_g DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+-- Migrazioni Step 12: bins.ingest_key
+ALTER TABLE bins ADD COLUMN IF NOT EXISTS ingest_key TEXT;
+
+-- Migrazioni Step 10: eventi AI-ready
+ALTER TABLE events ADD COLUMN IF NOT EXISTS source TEXT;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS model_version TEXT;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS confidence DOUBLE PRECISION;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS topk_json TEXT;
+ALTER TABLE events ADD COLUMN IF NOT EXISTS image_ref TEXT;
+
+-- Migrazione: events.ts da TEXT ISO a TIMESTAMPTZ nativo
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'events' AND column_name = 'ts'
+          AND data_type = 'text'
+    ) THEN
+        ALTER TABLE events ALTER COLUMN ts TYPE TIMESTAMPTZ USING ts::timestamptz;
+    END IF;
+END
+$$;
+"""
+
+# Postgres: indici covering (index-only scan per le daily), creati CONCURRENTLY:
+# non possono girare dentro una transazione, uno statement alla volta in autocommit.
+# (nome, DDL): creato se manca o se rimasto INVALID (vedi _pg_sync_indexes)
+_PG_INDEXES: Final = (
+    ("idx_events_ts_cov",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_ts_cov "
+     "ON events(ts) INCLUDE (bin_id, material, weight_g, co2_saved_g)"),
+    ("idx_events_bin_ts_cov",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_bin_ts_cov "
+     "ON events(bin_id, ts) INCLUDE (material, weight_g, co2_saved_g)"),
+    ("idx_events_bin_id",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_bin_id "
+     "ON events(bin_id, id)"),
+)
+# indici sostituiti dai covering: eliminati dopo aver creato i nuovi
+_PG_DROPPED_INDEXES: Final = ("idx_events_ts", "idx_events_bin_ts", "idx_events_material")
+# advisory lock delle migrazioni (chiave: costante arbitraria dell'app) e attesa tra i tentativi
+_PG_MIGRATION_LOCK_KEY: Final = 0x50127101
+PG_MIGRATION_LOCK_POLL_S = 0.2
+
+
+# Ricostruisce events_daily da events; no-op se events_daily contiene già righe
+# (all'avvio popola la tabella appena creata su un DB con storico)
+_BACKFILL_EVENTS_DAILY: Final = """
+INSERT INTO events_daily(day, bin_id, weight_g, co2_saved_g)
+SELECT :TS_DAY, bin_id, SUM(weight_g), SUM(co2_saved_g)
+FROM events
+WHERE NOT EXISTS (SELECT 1 FROM events_daily)
+GROUP BY :TS_DAY, bin_id
+"""
+
+# idem per events_material
+_BACKFILL_EVENTS_MATERIAL: Final = """
+INSERT INTO events_material(material, weight_g, co2_saved_g)
+SELECT material, SUM(weight_g), SUM(co2_saved_g)
+FROM events
+WHERE NOT EXISTS (SELECT 1 FROM events_material)
+GROUP BY material
+"""
+
+
+def rebuild_aggregates() -> None:
+    # events_daily + events_material ricalcolati da events in una sola transazione
+    with get_conn() as conn:
+        conn.execute("DELETE FROM events_daily")
+        conn.execute("DELETE FROM events_material")
+        conn.execute(_BACKFILL_EVENTS_DAILY)
+        conn.execute(_BACKFILL_EVENTS_MATERIAL)
 
 
 def init_db() -> None:
-    with get_conn() as conn:
-        if conn.backend == "sqlite":
-            # SQLite: crea tabelle base
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS bins (
-                    bin_id TEXT PRIMARY KEY,
-                    capacity_g REAL NOT NULL DEFAULT 10000,
-                    current_weight_g REAL NOT NULL DEFAULT 0,
-                    last_seen TEXT
-                )
-            """)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS events (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ts TEXT NOT NULL,
-                    bin_id TEXT NOT NULL,
-                    material TEXT NOT NULL,
-                    weight_g REAL NOT NULL,
-                    co2_saved_g REAL NOT NULL,
-                    FOREIGN KEY(bin_id) REFERENCES bins(bin_id)
-                )
-            """)
-
-            # Migrazioni Step 12: bins.ingest_key
-            _sqlite_add_column_if_missing(conn, "bins", "ingest_key", "TEXT")
-
-            # Migrazioni Step 10: eventi AI-ready
-            _sqlite_add_column_if_missing(conn, "events", "source", "TEXT")
-            _sqlite_add_column_if_missing(conn, "events", "model_version", "TEXT")
-            _sqlite_add_column_if_missing(conn, "events", "confidence", "REAL")
-            _sqlite_add_column_if_missing(conn, "events", "topk_json", "TEXT")
-            _sqlite_add_column_if_missing(conn, "events", "image_ref", "TEXT")
-
-        else:
-            # Postgres: crea tabelle base
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS bins (
-                    bin_id TEXT PRIMARY KEY,
-                    capacity_g DOUBLE PRECISION NOT NULL DEFAULT 10000,
-                    current_weight_g DOUBLE PRECISION NOT NULL DEFAULT 0,
-                    last_seen TEXT
-                )
-            """)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS events (
-                    id BIGSERIAL PRIMARY KEY,
-                    ts TEXT NOT NULL,
-                    bin_id TEXT NOT NULL REFERENCES bins(bin_id),
-                    material TEXT NOT NULL,
-                    weight_g DOUBLE PRECISION NOT NULL,
-                    co2_saved_g DOUBLE PRECISION NOT NULL
-                )
-            """)
-
-            # Migrazioni Step 12: bins.ingest_key
-            _pg_add_column_if_missing(conn, "bins", "ingest_key", "TEXT")
-
-            # Migrazioni Step 10: eventi AI-ready
-            _pg_add_column_if_missing(conn, "events", "source", "TEXT")
-            _pg_add_column_if_missing(conn, "events", "model_version", "TEXT")
-            _pg_add_column_if_missing(conn, "events", "confidence", "DOUBLE PRECISION")
-            _pg_add_column_if_missing(conn, "events", "topk_json", "TEXT")
-            _pg_add_column_if_missing(conn, "events", "image_ref", "TEXT")
+    if not USE_POSTGRES:
+        with get_conn() as conn:
+            conn.executescript(_DDL_SQLITE)
+
+            # SQLite non ha ADD COLUMN IF NOT EXISTS: migrazioni via introspezione
+            _sqlite_migrate_columns(conn)
+
+            conn.execute(_BACKFILL_EVENTS_DAILY)
+            conn.execute(_BACKFILL_EVENTS_MATERIAL)
+
+            # su Postgres ci pensa autovacuum
+            conn.executescript(_ANALYZE_SQLITE)
+        return
+
+    # DDL transazionale (ALTER = AccessExclusiveLock) e build CONCURRENTLY di un altro
+    # worker si bloccherebbero a vicenda: tutta la migrazione sotto lo stesso lock
+    with _pg_migration_lock():
+        with get_conn() as conn:
+            conn.executescript(_DDL_PG)
+            conn.execute(_BACKFILL_EVENTS_DAILY)
+            conn.execute(_BACKFILL_EVENTS_MATERIAL)
+        _pg_sync_indexes()
 
 
 
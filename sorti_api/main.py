@@ -1,19 +1,53 @@
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from fastapi import Depends, FastAPI, HTTPException, Header, Request
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-from datetime import datetime, timezone, timedelta
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import datetime, timezone
 import json
+import logging
 import os
+import contextlib
 import csv
 import io
+import itertools
+import zlib
 import time
 import secrets
+import hmac
+import hashlib
 import asyncio
+import threading
+from concurrent.futures import Future
 from pathlib import Path
 from typing import Any, Optional
 
-from .db import init_db, get_conn
+from .db import (
+    DBBusyError, DBConn, EXPORT_MAX_CONCURRENT, init_db, get_conn, get_export_conn, ping,
+    rebuild_aggregates, close_pools,
+)
+
+logger = logging.getLogger("sorti_api")
+
+try:
+    import orjson
+except ImportError:  # opzionale: senza orjson si resta sul json della stdlib
+    orjson = None
+
+
+# JSON per payload SSE e topk_json: orjson se disponibile (sempre UTF-8, come ensure_ascii=False).
+# Formato compatto in entrambi i casi: il payload SSE va a ogni client connesso.
+# loads_json legge direttamente bytes (file letti con read_bytes, niente decode a str)
+if orjson is not None:
+    def dumps_json(v: Any) -> str:
+        return orjson.dumps(v).decode("utf-8")
+
+    loads_json = orjson.loads
+else:
+    def dumps_json(v: Any) -> str:
+        return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+
+    loads_json = json.loads
+
 
 # =========================
 # Percorsi del progetto
@@ -24,10 +58,87 @@ STATIC_DIR = APP_DIR / "static"
 INDEX_HTML = STATIC_DIR / "index.html"
 
 
-def load_factors() -> dict:
-    if not FACTORS_PATH.exists():
+# cache fattori CO2: (mtime, fattori, materiale normalizzato -> fattore float).
+# Riletti solo se il file cambia; mtime controllato al più ogni FACTORS_CHECK_INTERVAL_S
+FACTORS_CHECK_INTERVAL_S = 5.0
+_factors_cache: Optional[tuple[float, dict, dict[str, float]]] = None
+_factors_checked_at = 0.0
+
+
+def _load_factors_cached() -> tuple[float, dict, dict[str, float]]:
+    global _factors_cache, _factors_checked_at
+    # hot path dell'ingest: nessuna syscall finché il controllo è recente
+    now = time.monotonic()
+    cached = _factors_cache
+    if cached is not None and now - _factors_checked_at < FACTORS_CHECK_INTERVAL_S:
+        return cached
+
+    try:
+        mtime = FACTORS_PATH.stat().st_mtime
+    except FileNotFoundError:
         raise RuntimeError(f"Manca il file fattori CO2: {FACTORS_PATH}")
-    return json.loads(FACTORS_PATH.read_text(encoding="utf-8"))
+    _factors_checked_at = now
+
+    if cached is None or cached[0] != mtime:
+        factors = loads_json(FACTORS_PATH.read_bytes())
+        # lookup piatto: una sola get() per evento, fattore già float
+        material_to_factor = {str(k).strip().lower(): float(v) for k, v in factors.items()}
+        cached = (mtime, factors, material_to_factor)
+        _factors_cache = cached
+    return cached
+
+
+def load_factors() -> dict:
+    return _load_factors_cached()[1]
+
+
+def reload_factors() -> dict:
+    # rilettura forzata: copre file sostituiti mantenendo lo stesso mtime (rsync -t, cp -p)
+    global _factors_cache
+    _factors_cache = None
+    return load_factors()
+
+
+def material_factor(material: str) -> Optional[float]:
+    # material già normalizzato (strip + lower); None se sconosciuto
+    return _load_factors_cached()[2].get(material)
+
+
+# =========================
+# Helper: timestamp eventi
+# =========================
+def iso_ts(v: Any) -> str:
+    # events.ts: datetime su Postgres (TIMESTAMPTZ), già stringa ISO su SQLite
+    if isinstance(v, datetime):
+        return v.astimezone(timezone.utc).isoformat()
+    return v
+
+
+# (secondo epoch, stringa ISO): nello stesso secondo le risposte riusano la stringa già formattata
+_now_iso_cache: tuple[int, str] = (0, "")
+
+
+def _now_iso() -> str:
+    # istante corrente UTC lato app, al secondo (le scritture usano invece il clock del DB: :NOW / :NOW_TS).
+    # Tupla sostituita in blocco: letture concorrenti vedono sempre una coppia coerente
+    global _now_iso_cache
+    sec = int(time.time())
+    cached = _now_iso_cache
+    if cached[0] != sec:
+        cached = (sec, datetime.fromtimestamp(sec, timezone.utc).isoformat())
+        _now_iso_cache = cached
+    return cached[1]
+
+
+# =========================
+# Helper: limiti parametri query
+# =========================
+def clamp_days(days: int) -> int:
+    return max(1, min(int(days), 365))
+
+
+def clamp_limit(limit: int) -> int:
+    return max(1, min(int(limit), 200))
 
 
 # =========================
@@ -35,7 +146,10 @@ def load_factors() -> dict:
 # =========================
 
 class EventIn(BaseModel):
-    bin_id: str = Field(..., examples=["SORTI_001"])
+    # payload di sola lettura: niente hook di assegnazione
+    model_config = ConfigDict(frozen=True)
+
+    bin_id: str = Field(..., min_length=1, examples=["SORTI_001"])
     material: str = Field(..., examples=["plastica"])
     weight_g: float = Field(..., gt=0, examples=[18])
 
@@ -50,7 +164,19 @@ class EventIn(BaseModel):
     image_ref: Optional[str] = Field(default=None, examples=["frame_2026-01-18T10:22:11Z.jpg"])
 
 
+# eventi massimi per una richiesta di ingest in blocco
+INGEST_BULK_MAX = 500
+
+
+class EventsBulkIn(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    events: list[EventIn] = Field(..., min_length=1, max_length=INGEST_BULK_MAX)
+
+
 class BinConfigIn(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     capacity_g: float = Field(..., gt=0, examples=[120000])
 
 
@@ -62,7 +188,26 @@ class BinKeyOut(BaseModel):
 # =========================
 # APP FastAPI
 # =========================
-app = FastAPI(title="Sorti SmartBin Tracker")
+JSON_RESPONSE_CLASS = ORJSONResponse if orjson is not None else JSONResponse
+
+app = FastAPI(
+    title="Sorti SmartBin Tracker",
+    default_response_class=JSON_RESPONSE_CLASS,
+)
+
+
+def json_response(content: Any, headers: Optional[dict[str, str]] = None) -> Response:
+    # per gli endpoint caldi: un dict restituito passa prima da jsonable_encoder (visita
+    # ricorsiva in Python, ~1 ms per una dashboard); i contenuti qui sono già tipi JSON
+    # (str/float/int/None), la Response costruita direttamente serializza in un passo solo
+    return JSON_RESPONSE_CLASS(content, headers=headers)
+
+
+@app.exception_handler(DBBusyError)
+async def _db_busy(request: Request, exc: DBBusyError) -> Response:
+    # pool DB esaurito oltre DB_POOL_TIMEOUT_S: 503 invece di tenere il thread in attesa
+    return JSON_RESPONSE_CLASS({"detail": str(exc)}, status_code=503, headers={"Retry-After": "1"})
+
 
 # =========================
 # Sicurezza: 2 chiavi separate
@@ -70,60 +215,170 @@ app = FastAPI(title="Sorti SmartBin Tracker")
 ADMIN_KEY = os.getenv("SORTI_ADMIN_KEY", "SORTI-DEMO-KEY-BINARO-2026-01")
 GLOBAL_INGEST_KEY = os.getenv("SORTI_INGEST_KEY", "SORTI-DEMO-KEY-BINARO-2026-01")
 RATE_EVENTS_PER_MIN = int(os.getenv("SORTI_RATE_EVENTS_PER_MIN", "60"))
+# capienza del bucket (raffica massima per chiave), separata dalla ricarica al minuto:
+# di default un lotto bufferizzato da INGEST_BULK_MAX eventi passa, poi si riparte al ritmo normale
+RATE_BURST_EVENTS = int(os.getenv("SORTI_RATE_BURST_EVENTS", str(max(RATE_EVENTS_PER_MIN, INGEST_BULK_MAX))))
+
+# chiave admin già in bytes: controllata a ogni richiesta admin, codificata una volta sola
+_ADMIN_KEY_B = ADMIN_KEY.encode("utf-8")
+
+
+def key_matches(given: str | None, expected: str | bytes) -> bool:
+    # confronto a tempo costante; bytes perché compare_digest su str accetta solo ASCII
+    if given is None:
+        return False
+    if isinstance(expected, str):
+        expected = expected.encode("utf-8")
+    return hmac.compare_digest(given.encode("utf-8"), expected)
 
 
 def require_admin_key(x_api_key: str | None) -> None:
-    if x_api_key != ADMIN_KEY:
+    if not key_matches(x_api_key, _ADMIN_KEY_B):
         raise HTTPException(status_code=401, detail="Unauthorized (admin)")
 
 
 def is_admin(x_api_key: str | None) -> bool:
-    return (x_api_key == ADMIN_KEY)
+    return key_matches(x_api_key, _ADMIN_KEY_B)
+
+
+async def _admin_required(x_api_key: str | None = Header(default=None)) -> None:
+    # dependency degli endpoint ADMIN: 401 prima di validare body/handler.
+    # async: solo un compare_digest, niente salto nel threadpool come per le dependency sync
+    require_admin_key(x_api_key)
+
+
+AdminKey = Depends(_admin_required)
 
 
 # =========================
 # Rate limiter semplice (in-memory)
 # =========================
-_rl: dict[str, list[float]] = {}
+# token bucket per chiave: (token disponibili, ultimo aggiornamento). O(1) per evento.
+# Capienza RATE_BURST_EVENTS, ricarica RATE_EVENTS_PER_MIN per RL_WINDOW_S
+_rl: dict[str, tuple[float, float]] = {}
+_rl_lock = threading.Lock()
+RL_WINDOW_S = 60.0
+RL_MAX_KEYS = 1024
 
 
-def rate_limit_or_429(key: str) -> None:
-    now = time.time()
-    window = 60.0
-    limit = max(1, RATE_EVENTS_PER_MIN)
+def _rl_capacity() -> tuple[float, float]:
+    # (capienza, token ricaricati al secondo)
+    rate = float(max(1, RATE_EVENTS_PER_MIN))
+    return float(max(RATE_BURST_EVENTS, rate)), rate / RL_WINDOW_S
+
+
+def _rl_sweep(now: float) -> None:
+    # un bucket fermo abbastanza da essersi ricaricato del tutto equivale a non averlo
+    capacity, per_s = _rl_capacity()
+    refill_s = capacity / per_s
+    for k in [k for k, (_, last) in _rl.items() if now - last >= refill_s]:
+        del _rl[k]
+
+
+def rate_limit_many_or_429(costs: dict[str, float]) -> None:
+    # costs = chiave -> eventi della richiesta (l'ingest in blocco consuma un token per evento).
+    # Tutto o niente: se un bucket non basta non si scala nessun token
+    capacity, per_s = _rl_capacity()
+    if any(cost > capacity for cost in costs.values()):
+        # più eventi della capienza del bucket: un 429 non si risolverebbe mai aspettando
+        raise HTTPException(status_code=413, detail=f"Troppi eventi per chiave: max {int(capacity)} per richiesta")
 
-    arr = _rl.get(key, [])
-    arr = [t for t in arr if (now - t) <= window]
+    with _rl_lock:
+        now = time.monotonic()
+        tokens: dict[str, float] = {}
+        for key in costs:
+            t, last = _rl.get(key, (capacity, now))
+            tokens[key] = min(capacity, t + (now - last) * per_s)
 
-    if len(arr) >= limit:
-        raise HTTPException(status_code=429, detail="Rate limit exceeded (ingest)")
+        if any(tokens[key] < cost for key, cost in costs.items()):
+            for key, t in tokens.items():
+                _rl[key] = (t, now)
+            raise HTTPException(status_code=429, detail="Rate limit exceeded (ingest)")
 
-    arr.append(now)
-    _rl[key] = arr
+        for key, cost in costs.items():
+            _rl[key] = (tokens[key] - cost, now)
+        if len(_rl) > RL_MAX_KEYS:
+            _rl_sweep(now)
+
+
+def rate_limit_or_429(key: str, cost: float = 1.0) -> None:
+    rate_limit_many_or_429({key: cost})
 
 
 # =========================
 # SSE: broker aggiornamenti
 # =========================
 _sse_clients: set[asyncio.Queue] = set()
+# event loop delle connessioni SSE (impostato dal primo client di /api/stream)
+_sse_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# frame fissi già codificati
+_SSE_HELLO = b"event: hello\ndata: ok\n\n"
+_SSE_KEEPALIVE = b": keepalive\n\n"
+
+# finestra di coalescenza: i frame pubblicati entro 10 ms partono insieme
+# (una put per client e un solo send), es. svuotamento in sequenza di molti bin
+SSE_COALESCE_S = 0.01
+_sse_pending: list[bytes] = []
+_sse_pending_lock = threading.Lock()
+
+
+def _sse_fanout(frame: bytes) -> None:
+    # gira sull'event loop: le asyncio.Queue non sono thread-safe
+    dead = []
+    for q in _sse_clients:
+        try:
+            q.put_nowait(frame)
+        except asyncio.QueueFull:
+            dead.append(q)
+    for q in dead:
+        _sse_clients.discard(q)
+
+
+def _sse_flush() -> None:
+    # sull'event loop, SSE_COALESCE_S dopo il primo frame in attesa
+    global _sse_pending
+    with _sse_pending_lock:
+        frames, _sse_pending = _sse_pending, []
+    if frames:
+        _sse_fanout(frames[0] if len(frames) == 1 else b"".join(frames))
+
+
+def _sse_reset(loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+    # nuovo loop (o nessuno, allo shutdown): i frame in attesa erano programmati sul
+    # loop precedente e non partirebbero più, bloccando ogni flush successivo
+    global _sse_loop, _sse_pending
+    with _sse_pending_lock:
+        _sse_pending = []
+        _sse_loop = loop
 
 
 def sse_publish(event: str = "update", data: dict | str | None = None) -> None:
+    # chiamata dagli endpoint sync (threadpool): serializza e passa il fan-out al loop,
+    # la request non itera i client
+    loop = _sse_loop
+    if loop is None or not _sse_clients:
+        return
+
     if data is None:
         payload = ""
     elif isinstance(data, str):
         payload = data
     else:
-        payload = json.dumps(data, ensure_ascii=False)
-
-    dead = []
-    for q in list(_sse_clients):
+        payload = dumps_json(data)
+
+    # frame SSE formattato e codificato una volta: ogni client riceve gli stessi bytes
+    frame = f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
+    with _sse_pending_lock:
+        _sse_pending.append(frame)
+        first = len(_sse_pending) == 1
+    # solo il primo frame della finestra programma il flush, gli altri si accodano
+    if first:
         try:
-            q.put_nowait((event, payload))
-        except Exception:
-            dead.append(q)
-    for q in dead:
-        _sse_clients.discard(q)
+            loop.call_soon_threadsafe(loop.call_later, SSE_COALESCE_S, _sse_flush)
+        except RuntimeError:
+            # loop chiuso: la scrittura è già committata, si perde solo la notifica (niente 500)
+            _sse_reset()
 
 
 # =========================
@@ -134,20 +389,65 @@ if STATIC_DIR.exists():
 
 
 # =========================
-# Startup: inizializza DB
+# Startup / shutdown: DB
 # =========================
 @app.on_event("startup")
 def _startup():
     init_db()
+    # fattori CO2 precaricati se possibile: un file mancante o illeggibile non blocca
+    # dashboard, /health ed export, l'errore si ripresenta al primo ingest
+    try:
+        load_factors()
+    except (RuntimeError, ValueError) as e:
+        logger.warning("Fattori CO2 non caricati all'avvio: %s", e)
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    _sse_reset()
+    close_pools()
 
 
 # =========================
 # Pagina principale
 # =========================
+# cache index.html: (mtime, bytes, etag). Riletto solo se il file cambia;
+# mtime controllato al più ogni INDEX_CHECK_INTERVAL_S (come i fattori CO2)
+INDEX_CHECK_INTERVAL_S = 5.0
+_index_cache: Optional[tuple[float, bytes, str]] = None
+_index_checked_at = 0.0
+
+
+def load_index_html() -> Optional[tuple[float, bytes, str]]:
+    global _index_cache, _index_checked_at
+    now = time.monotonic()
+    cached = _index_cache
+    if cached is not None and now - _index_checked_at < INDEX_CHECK_INTERVAL_S:
+        return cached
+
+    try:
+        mtime = INDEX_HTML.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    _index_checked_at = now
+
+    if cached is None or cached[0] != mtime:
+        body = INDEX_HTML.read_bytes()
+        cached = (mtime, body, '"' + hashlib.md5(body).hexdigest() + '"')
+        _index_cache = cached
+    return cached
+
+
 @app.get("/", response_class=HTMLResponse)
-def home():
-    if INDEX_HTML.exists():
-        return HTMLResponse(INDEX_HTML.read_text(encoding="utf-8"))
+def home(if_none_match: str | None = Header(default=None)):
+    cached = load_index_html()
+    if cached is not None:
+        _, body, etag = cached
+        # no-cache: il browser rivalida a ogni visita, ma con l'ETag riceve solo un 304
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(body, headers=headers)
     return HTMLResponse(
         "<h2>Sorti server attivo ✅</h2>"
         "<p>Non trovo <code>sorti_api/static/index.html</code>. "
@@ -160,8 +460,7 @@ def home():
 # =========================
 @app.get("/health")
 def health():
-    with get_conn() as conn:
-        conn.execute("SELECT 1").fetchone()
+    ping()
     return {"ok": True}
 
 
@@ -173,23 +472,27 @@ async def stream():
     # NOTE: EventSource non può inviare header (X-API-Key).
     # Questo endpoint è pubblico e manda solo notifiche/payload.
     async def event_generator():
+        loop = asyncio.get_running_loop()
+        if _sse_loop is not loop:
+            _sse_reset(loop)
+
         q: asyncio.Queue = asyncio.Queue(maxsize=50)
         _sse_clients.add(q)
 
         # hello iniziale (la UI lo ascolta)
-        yield "event: hello\ndata: ok\n\n"
+        yield _SSE_HELLO
 
         try:
             while True:
                 try:
-                    event, payload = await asyncio.wait_for(q.get(), timeout=15.0)
-                    if payload == "":
-                        yield f"event: {event}\ndata: \n\n"
-                    else:
-                        yield f"event: {event}\ndata: {payload}\n\n"
+                    yield await asyncio.wait_for(q.get(), timeout=15.0)
                 except asyncio.TimeoutError:
+                    # client troppo lento (coda piena) già rimosso dal fan-out: chiudi,
+                    # EventSource si riconnette e la UI ricarica lo stato
+                    if q not in _sse_clients:
+                        return
                     # keepalive per proxy / hosting
-                    yield ": keepalive\n\n"
+                    yield _SSE_KEEPALIVE
         finally:
             _sse_clients.discard(q)
 
@@ -197,82 +500,144 @@ async def stream():
 
 
 # =========================
-# Helper: daily aggregation (globale)
+# Cache daily (in-memory): days -> (scadenza, versione dati, risultato)
 # =========================
-def compute_daily(days: int) -> list[dict]:
-    days = max(1, min(int(days), 365))
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-    cutoff_iso = cutoff.isoformat()
+DAILY_CACHE_GRACE_S = 300.0
+_daily_cache: dict[int, tuple[float, int, list[dict]]] = {}
 
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT ts, weight_g, co2_saved_g
-            FROM events
-            WHERE ts >= ?
-            ORDER BY ts ASC
-        """, (cutoff_iso,)).fetchall()
 
-    agg: dict[str, dict] = {}
-    for r in rows:
-        ts_val = r["ts"]
-        if isinstance(ts_val, datetime):
-            day = ts_val.date().isoformat()
-        else:
-            day = str(ts_val)[:10]
+def _daily_cache_expiry(now: float) -> float:
+    # valida fino a fine giornata UTC (+ margine); gli eventi nuovi la invalidano.
+    # epoch UTC senza leap second: la mezzanotte successiva è un multiplo di 86400
+    return (now // 86400 + 1) * 86400 + DAILY_CACHE_GRACE_S
 
-        w = float(r["weight_g"] or 0)
-        c = float(r["co2_saved_g"] or 0)
 
-        if day not in agg:
-            agg[day] = {"day": day, "weight_g": 0.0, "co2_saved_g": 0.0}
+def invalidate_daily_cache() -> None:
+    _daily_cache.clear()
+
+
+# =========================
+# Cache HTTP: ETag su statistiche e dashboard
+# =========================
+# versione dei dati in memoria, incrementata dopo ogni scrittura committata.
+# Il token di processo distingue i riavvii. Vale per un solo processo: con più worker uno
+# che non ha visto la scrittura risponderebbe 304 a torto. L'app va eseguita con un solo
+# worker uvicorn (come già richiesto da broker SSE, rate limiter e cache in memoria)
+_DATA_EPOCH = secrets.token_hex(4)
+_data_version = 0
+_data_version_lock = threading.Lock()
+
 
-        agg[day]["weight_g"] += w
-        agg[day]["co2_saved_g"] += c
+def bump_data_version() -> None:
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
 
-    return [agg[k] for k in sorted(agg.keys())]
+
+def data_etag(*parts: Any) -> str:
+    # giorno UTC incluso: le finestre "ultimi N giorni" scorrono a mezzanotte anche senza scritture
+    day = int(time.time() // 86400)
+    return '"' + "-".join(str(p) for p in (_DATA_EPOCH, _data_version, day, *parts)) + '"'
+
+
+def check_etag(etag: str, if_none_match: str | None) -> tuple[dict[str, str], Optional[Response]]:
+    # (header da mettere sulla risposta, 304 pronto se il client ha già questa versione).
+    # no-cache (come home): la UI ricarica subito dopo ogni evento SSE, un max-age la servirebbe
+    # stantia; la rivalidazione costa un 304 senza query. private: la dashboard admin ha eventi
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match == etag:
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
 
 
 # =========================
-# ✅ Helper: daily aggregation (per-bin)
+# Helper: daily aggregation (globale)
 # =========================
-def compute_daily_for_bin(bin_id: str, days: int) -> list[dict]:
-    days = max(1, min(int(days), 365))
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-    cutoff_iso = cutoff.isoformat()
+def compute_daily(days: int, conn: Optional[DBConn] = None) -> list[dict]:
+    days = clamp_days(days)
 
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT ts, weight_g, co2_saved_g
-            FROM events
-            WHERE ts >= ? AND bin_id = ?
-            ORDER BY ts ASC
-        """, (cutoff_iso, bin_id)).fetchall()
+    now = time.time()
+    # versione letta prima della query: un risultato calcolato su uno snapshot antecedente
+    # a un commit resta con la versione vecchia e non viene più servito dopo il bump
+    version = _data_version
+    hit = _daily_cache.get(days)
+    if hit is not None and hit[0] > now and hit[1] == version:
+        return hit[2]
+
+    # conn opzionale: la dashboard passa la propria invece di prenderne un'altra dal pool
+    if conn is None:
+        with get_conn(readonly=True) as c:
+            result = _query_daily(c, days)
+    else:
+        result = _query_daily(conn, days)
+    _daily_cache[days] = (_daily_cache_expiry(now), version, result)
+    return result
 
-    agg: dict[str, dict] = {}
-    for r in rows:
-        ts_val = r["ts"]
-        if isinstance(ts_val, datetime):
-            day = ts_val.date().isoformat()
-        else:
-            day = str(ts_val)[:10]
 
-        w = float(r["weight_g"] or 0)
-        c = float(r["co2_saved_g"] or 0)
+def _daily_rows(rows: list[tuple]) -> list[dict]:
+    # righe già aggregate dal DB (<= 365): SUM su colonne REAL è già float.
+    # Tuple spacchettate: niente lookup delle colonne per nome
+    return [
+        {"day": day, "weight_g": weight_g, "co2_saved_g": co2_saved_g}
+        for day, weight_g, co2_saved_g in rows
+    ]
+
+
+def _query_daily(conn: DBConn, days: int) -> list[dict]:
+    # da events_daily (giorno UTC x bin): al massimo days x n_bin righe lette.
+    # ogni gruppo ha almeno una riga e le colonne sono NOT NULL: SUM mai NULL
+    rows = conn.fetch_tuples("""
+        SELECT
+          day,
+          SUM(weight_g) AS weight_g,
+          SUM(co2_saved_g) AS co2_saved_g
+        FROM events_daily
+        WHERE day >= :CUTOFF_DAY
+        GROUP BY day
+        ORDER BY day ASC
+    """, (days,))
+
+    return _daily_rows(rows)
 
-        if day not in agg:
-            agg[day] = {"day": day, "weight_g": 0.0, "co2_saved_g": 0.0}
 
-        agg[day]["weight_g"] += w
-        agg[day]["co2_saved_g"] += c
+# =========================
+# ✅ Helper: daily aggregation (per-bin)
+# =========================
+def compute_daily_for_bin(bin_id: str, days: int) -> list[dict]:
+    days = clamp_days(days)
+
+    with get_conn(readonly=True) as conn:
+        rows = conn.fetch_tuples("""
+            SELECT day, weight_g, co2_saved_g
+            FROM events_daily
+            WHERE day >= :CUTOFF_DAY AND bin_id = ?
+            ORDER BY day ASC
+        """, (days, bin_id))
 
-    return [agg[k] for k in sorted(agg.keys())]
+    return _daily_rows(rows)
 
 
 # =========================
 # Step 12: per-bin ingest key
 # =========================
+# cache chiavi ingest: bin_id -> (scadenza monotonic, chiave attesa).
+# Evita una SELECT per evento. rotate_ingest_key aggiorna subito la voce (app a worker
+# singolo); il TTL serve solo per le modifiche a bins.ingest_key fatte fuori dall'app
+# (script, SQL a mano), che diventano visibili entro BIN_KEY_CACHE_TTL_S
+BIN_KEY_CACHE_TTL_S = 30.0
+_bin_key_cache: dict[str, tuple[float, str]] = {}
+# incrementato a ogni rotazione: una lettura partita prima non salva la chiave vecchia
+_bin_key_gen = 0
+
+
 def resolve_bin_ingest_key(bin_id: str) -> str:
-    with get_conn() as conn:
+    now = time.monotonic()
+    hit = _bin_key_cache.get(bin_id)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+
+    gen = _bin_key_gen
+    with get_conn(readonly=True) as conn:
         row = conn.execute(
             "SELECT ingest_key FROM bins WHERE bin_id=?",
             (bin_id,)
@@ -282,16 +647,23 @@ def resolve_bin_ingest_key(bin_id: str) -> str:
         raise HTTPException(status_code=404, detail="Bin non trovato (configura prima il bin)")
 
     k = row.get("ingest_key") if isinstance(row, dict) else row["ingest_key"]
-    if k and str(k).strip():
-        return str(k).strip()
-    return GLOBAL_INGEST_KEY
+    expected = str(k).strip() if k and str(k).strip() else GLOBAL_INGEST_KEY
+    # solo bin esistenti: un bin_id sconosciuto non occupa la cache
+    if gen == _bin_key_gen:
+        _bin_key_cache[bin_id] = (now + BIN_KEY_CACHE_TTL_S, expected)
+    return expected
 
 
-def require_ingest_for_bin(bin_id: str, x_ingest_key: str | None) -> None:
+def authorize_ingest_for_bin(bin_id: str, x_ingest_key: str | None) -> str:
+    # 401 se la chiave non vale per il bin; restituisce la chiave del bucket di rate limit
     expected = resolve_bin_ingest_key(bin_id)
-    if x_ingest_key != expected:
+    if not key_matches(x_ingest_key, expected):
         raise HTTPException(status_code=401, detail="Unauthorized (ingest/bin)")
-    rate_limit_or_429(expected)
+    return expected
+
+
+def require_ingest_for_bin(bin_id: str, x_ingest_key: str | None) -> None:
+    rate_limit_or_429(authorize_ingest_for_bin(bin_id, x_ingest_key))
 
 
 # =========================
@@ -301,24 +673,32 @@ def require_ingest_for_bin(bin_id: str, x_ingest_key: str | None) -> None:
 def set_bin_config(
     bin_id: str,
     cfg: BinConfigIn,
-    x_api_key: str | None = Header(default=None),
+    _: None = AdminKey,
 ):
-    require_admin_key(x_api_key)
-    now = datetime.now(timezone.utc).isoformat()
-
     with get_conn() as conn:
-        conn.execute("""
+        # timestamp dal DB (:NOW); RETURNING restituisce la riga canonica post-upsert
+        row = conn.execute("""
             INSERT INTO bins(bin_id, capacity_g, current_weight_g, last_seen, ingest_key)
-            VALUES(?, ?, 0, ?, NULL)
+            VALUES(?, ?, 0, :NOW, NULL)
             ON CONFLICT(bin_id) DO UPDATE SET
               capacity_g=excluded.capacity_g,
               last_seen=excluded.last_seen
-        """, (bin_id, float(cfg.capacity_g), now))
+            RETURNING bin_id, capacity_g, current_weight_g, last_seen
+        """, (bin_id, cfg.capacity_g)).fetchone()
+        now = row["last_seen"]
+
+    bump_data_version()
 
     # 🔔 notify realtime
     sse_publish("update", {"type": "config", "bin_id": bin_id, "ts": now})
 
-    return {"ok": True, "bin_id": bin_id, "capacity_g": float(cfg.capacity_g)}
+    return {
+        "ok": True,
+        "bin_id": row["bin_id"],
+        "capacity_g": float(row["capacity_g"]),
+        "current_weight_g": float(row["current_weight_g"]),
+        "last_seen": now,
+    }
 
 
 # =========================
@@ -327,25 +707,26 @@ def set_bin_config(
 @app.post("/api/bins/{bin_id}/rotate_ingest_key", response_model=BinKeyOut)
 def rotate_ingest_key(
     bin_id: str,
-    x_api_key: str | None = Header(default=None),
+    _: None = AdminKey,
 ):
-    require_admin_key(x_api_key)
-
+    global _bin_key_gen
     new_key = "SORTI-BIN-" + secrets.token_urlsafe(24)
-    now = datetime.now(timezone.utc).isoformat()
 
+    # come empty_bin: un solo UPDATE ... RETURNING, nessuna riga = bin inesistente
     with get_conn() as conn:
-        exists = conn.execute(
-            "SELECT bin_id FROM bins WHERE bin_id=?",
-            (bin_id,)
+        row = conn.execute(
+            "UPDATE bins SET ingest_key=?, last_seen=:NOW WHERE bin_id=? RETURNING last_seen",
+            (new_key, bin_id)
         ).fetchone()
-        if not exists:
-            raise HTTPException(status_code=404, detail="Bin non trovato (crealo prima con config)")
+    if row is None:
+        raise HTTPException(status_code=404, detail="Bin non trovato (crealo prima con config)")
+    now = row["last_seen"]
+    # last_seen cambiato: la dashboard non deve ricevere un 304 con il valore vecchio
+    bump_data_version()
 
-        conn.execute(
-            "UPDATE bins SET ingest_key=?, last_seen=? WHERE bin_id=?",
-            (new_key, now, bin_id)
-        )
+    # la chiave vecchia smette subito di valere
+    _bin_key_gen += 1
+    _bin_key_cache[bin_id] = (time.monotonic() + BIN_KEY_CACHE_TTL_S, new_key)
 
     # 🔔 notify realtime
     sse_publish("update", {"type": "rotate_key", "bin_id": bin_id, "ts": now})
@@ -353,6 +734,115 @@ def rotate_ingest_key(
     return {"bin_id": bin_id, "ingest_key": new_key}
 
 
+# =========================
+# Ingest: group commit
+# =========================
+# eventi massimi scritti in una sola transazione
+INGEST_BATCH_MAX = 128
+
+
+_SQL_UPSERT_MATERIAL = """
+    INSERT INTO events_material(material, weight_g, co2_saved_g)
+    VALUES(?, ?, ?)
+    ON CONFLICT(material) DO UPDATE SET
+      weight_g = events_material.weight_g + excluded.weight_g,
+      co2_saved_g = events_material.co2_saved_g + excluded.co2_saved_g
+"""
+
+
+def _write_event(conn: DBConn, row: tuple) -> tuple[Any, str, Any]:
+    bin_id, material, weight_g, co2_saved_g = row[:4]
+
+    # ts generato dal DB (:NOW_TS); RETURNING restituisce id + ts (compatibile sqlite+postgres)
+    erow = conn.execute("""
+        INSERT INTO events(
+          ts, bin_id, material, weight_g, co2_saved_g,
+          source, model_version, confidence, topk_json, image_ref
+        )
+        VALUES(:NOW_TS, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        RETURNING id, ts
+    """, row).fetchone()
+    ts = iso_ts(erow["ts"])
+
+    # peso + last_seen in un solo UPDATE; RETURNING evita la SELECT finale
+    brow = conn.execute("""
+        UPDATE bins
+        SET current_weight_g = current_weight_g + ?, last_seen=?
+        WHERE bin_id=?
+        RETURNING capacity_g, current_weight_g, :FILL_PERCENT AS fill_percent
+    """, (weight_g, ts, bin_id)).fetchone()
+
+    # aggregato giornaliero materializzato (ts è ISO UTC: i primi 10 caratteri sono il giorno)
+    conn.execute("""
+        INSERT INTO events_daily(day, bin_id, weight_g, co2_saved_g)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(day, bin_id) DO UPDATE SET
+          weight_g = events_daily.weight_g + excluded.weight_g,
+          co2_saved_g = events_daily.co2_saved_g + excluded.co2_saved_g
+    """, (ts[:10], bin_id, weight_g, co2_saved_g))
+
+    # totali per materiale materializzati: il report globale non scansiona events
+    conn.execute(_SQL_UPSERT_MATERIAL, (material, weight_g, co2_saved_g))
+
+    return erow["id"], ts, brow
+
+
+class _IngestBatcher:
+    # le add_event concorrenti si accodano; chi ottiene il lock di scrittura scrive
+    # tutti gli eventi in attesa in una sola transazione (un commit per N eventi).
+    # Ogni richiesta resta sincrona e riceve la propria riga
+    def __init__(self, max_batch: int):
+        self._max_batch = max_batch
+        self._pending: list[tuple[tuple, Future]] = []
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def submit(self, row: tuple) -> tuple[Any, str, Any]:
+        fut: Future = Future()
+        with self._pending_lock:
+            self._pending.append((row, fut))
+
+        with self._write_lock:
+            # il lotto di un'altra richiesta può aver già scritto anche questo evento
+            while not fut.done():
+                with self._pending_lock:
+                    batch = self._pending[:self._max_batch]
+                    del self._pending[:self._max_batch]
+                self._write(batch)
+        return fut.result()
+
+    def _write(self, batch: list[tuple[tuple, Future]]) -> None:
+        try:
+            with get_conn() as conn:
+                results = [_write_event(conn, row) for row, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # rollback del lotto: riprova un evento per transazione, un errore non coinvolge gli altri
+            for entry in batch:
+                self._write([entry])
+            return
+
+        for (_, fut), res in zip(batch, results):
+            fut.set_result(res)
+
+
+_ingest = _IngestBatcher(INGEST_BATCH_MAX)
+
+
+def resolve_material(raw: str) -> tuple[str, float]:
+    # fast path: i client inviano quasi sempre il nome già normalizzato, niente strip()/lower()
+    material = raw
+    factor = material_factor(material)
+    if factor is None:
+        material = material.strip().lower()
+        factor = material_factor(material)
+    if factor is None:
+        raise HTTPException(status_code=400, detail=f"Materiale sconosciuto: {material}")
+    return material, factor
+
+
 # =========================
 # API: aggiungi evento (INGEST)
 # =========================
@@ -363,57 +853,25 @@ def add_event(
 ):
     require_ingest_for_bin(ev.bin_id, x_ingest_key)
 
-    factors = load_factors()
-    material = ev.material.strip().lower()
-    if material not in factors:
-        raise HTTPException(status_code=400, detail=f"Materiale sconosciuto: {material}")
+    material, factor = resolve_material(ev.material)
+    weight_g = ev.weight_g
+    co2_saved_g = weight_g * factor
 
-    factor = float(factors[material])
-    co2_saved_g = float(ev.weight_g) * factor
-    ts = datetime.now(timezone.utc).isoformat()
+    # topk arriva già validato come JSON: la serializzazione (orjson se presente) non può fallire
+    topk_json = None if ev.topk is None else dumps_json(ev.topk)
 
-    topk_json = None
-    if ev.topk is not None:
-        try:
-            topk_json = json.dumps(ev.topk, ensure_ascii=False)
-        except Exception:
-            topk_json = None
+    event_id, ts, brow = _ingest.submit((
+        ev.bin_id, material, weight_g, co2_saved_g,
+        ev.source, ev.model_version, ev.confidence, topk_json, ev.image_ref
+    ))
 
-    with get_conn() as conn:
-        conn.execute("UPDATE bins SET last_seen=? WHERE bin_id=?", (ts, ev.bin_id))
-
-        conn.execute("""
-            INSERT INTO events(
-              ts, bin_id, material, weight_g, co2_saved_g,
-              source, model_version, confidence, topk_json, image_ref
-            )
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            ts, ev.bin_id, material, float(ev.weight_g), co2_saved_g,
-            ev.source, ev.model_version, ev.confidence, topk_json, ev.image_ref
-        ))
-
-        # recupero id evento (compatibile sqlite+postgres)
-        erow = conn.execute(
-            "SELECT id FROM events WHERE ts=? AND bin_id=? ORDER BY id DESC LIMIT 1",
-            (ts, ev.bin_id)
-        ).fetchone()
-        event_id = (erow.get("id") if isinstance(erow, dict) else erow["id"]) if erow else None
-
-        conn.execute("""
-            UPDATE bins
-            SET current_weight_g = current_weight_g + ?, last_seen=?
-            WHERE bin_id=?
-        """, (float(ev.weight_g), ts, ev.bin_id))
-
-        brow = conn.execute(
-            "SELECT capacity_g, current_weight_g FROM bins WHERE bin_id=?",
-            (ev.bin_id,)
-        ).fetchone()
+    # evento committato: le aggregazioni daily in cache non sono più valide
+    invalidate_daily_cache()
+    bump_data_version()
 
+    # RETURNING su SQLite non applica l'affinità REAL della colonna: float() qui resta
     capacity = float(brow["capacity_g"])
     current = float(brow["current_weight_g"])
-    fill_percent = 0.0 if capacity <= 0 else min(100.0, (current / capacity) * 100.0)
 
     # 🔥 notify realtime con payload completo per UI (tabella events live)
     sse_publish("update", {
@@ -421,25 +879,137 @@ def add_event(
         "ts": ts,
         "bin_id": ev.bin_id,
         "material": material,
-        "weight_g": float(ev.weight_g),
+        "weight_g": weight_g,
         "co2_saved_g": co2_saved_g,
         "event_id": event_id
     })
 
-    return {
+    return json_response({
         "ok": True,
         "ts": ts,
         "bin_id": ev.bin_id,
         "material": material,
-        "weight_g": float(ev.weight_g),
+        "weight_g": weight_g,
         "factor_gco2_per_g": factor,
         "co2_saved_g": co2_saved_g,
         "bin": {
             "capacity_g": capacity,
             "current_weight_g": current,
-            "fill_percent": fill_percent
+            "fill_percent": brow["fill_percent"]
         }
-    }
+    })
+
+
+# =========================
+# API: aggiungi eventi in blocco (INGEST)
+# =========================
+def _write_events_bulk(
+    conn: DBConn,
+    rows: list[tuple],
+    per_bin: dict[str, list[float]],
+    per_material: dict[str, list[float]],
+) -> tuple[str, list[dict]]:
+    # ts unico per il lotto (:NOW è testo ISO su entrambi i backend): stesso istante
+    # per gli eventi, per bins.last_seen e per il giorno dell'aggregato
+    ts = conn.execute("SELECT :NOW AS ts").fetchone()["ts"]
+
+    conn.executemany("""
+        INSERT INTO events(
+          ts, bin_id, material, weight_g, co2_saved_g,
+          source, model_version, confidence, topk_json, image_ref
+        )
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(ts, *row) for row in rows])
+
+    # bins ed events_daily: un UPDATE / upsert per bin distinto, non per evento
+    bins = []
+    for bin_id, (weight_g, co2_saved_g) in per_bin.items():
+        brow = conn.execute("""
+            UPDATE bins
+            SET current_weight_g = current_weight_g + ?, last_seen=?
+            WHERE bin_id=?
+            RETURNING capacity_g, current_weight_g, :FILL_PERCENT AS fill_percent
+        """, (weight_g, ts, bin_id)).fetchone()
+
+        conn.execute("""
+            INSERT INTO events_daily(day, bin_id, weight_g, co2_saved_g)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(day, bin_id) DO UPDATE SET
+              weight_g = events_daily.weight_g + excluded.weight_g,
+              co2_saved_g = events_daily.co2_saved_g + excluded.co2_saved_g
+        """, (ts[:10], bin_id, weight_g, co2_saved_g))
+
+        # RETURNING su SQLite non applica l'affinità REAL della colonna: float() qui resta
+        bins.append({
+            "bin_id": bin_id,
+            "capacity_g": float(brow["capacity_g"]),
+            "current_weight_g": float(brow["current_weight_g"]),
+            "fill_percent": brow["fill_percent"],
+        })
+
+    conn.executemany(_SQL_UPSERT_MATERIAL, [(m, w, c) for m, (w, c) in per_material.items()])
+    return ts, bins
+
+
+@app.post("/api/event/bulk")
+def add_events_bulk(
+    body: EventsBulkIn,
+    x_ingest_key: str | None = Header(default=None),
+):
+    # eventi bufferizzati dal dispositivo: un'unica transazione (un commit) per tutto il lotto
+    counts: dict[str, int] = {}
+    for ev in body.events:
+        counts[ev.bin_id] = counts.get(ev.bin_id, 0) + 1
+    # prima l'autenticazione di tutti i bin, poi i token in un colpo solo: un lotto
+    # rifiutato (401/413/429) non consuma il rate limit dei bin già verificati.
+    # Più bin sulla chiave globale condividono lo stesso bucket: i costi si sommano
+    costs: dict[str, float] = {}
+    for bin_id, n in counts.items():
+        key = authorize_ingest_for_bin(bin_id, x_ingest_key)
+        costs[key] = costs.get(key, 0) + n
+    rate_limit_many_or_429(costs)
+
+    rows = []
+    per_bin: dict[str, list[float]] = {}
+    per_material: dict[str, list[float]] = {}
+    for ev in body.events:
+        material, factor = resolve_material(ev.material)
+        weight_g = ev.weight_g
+        co2_saved_g = weight_g * factor
+        topk_json = None if ev.topk is None else dumps_json(ev.topk)
+        rows.append((
+            ev.bin_id, material, weight_g, co2_saved_g,
+            ev.source, ev.model_version, ev.confidence, topk_json, ev.image_ref
+        ))
+        for acc in (per_bin.setdefault(ev.bin_id, [0.0, 0.0]), per_material.setdefault(material, [0.0, 0.0])):
+            acc[0] += weight_g
+            acc[1] += co2_saved_g
+
+    with get_conn() as conn:
+        ts, bins = _write_events_bulk(conn, rows, per_bin, per_material)
+
+    invalidate_daily_cache()
+    bump_data_version()
+
+    # 🔔 notify realtime: un messaggio per bin, non uno per evento
+    for bin_id, (weight_g, co2_saved_g) in per_bin.items():
+        sse_publish("update", {
+            "type": "bulk",
+            "ts": ts,
+            "bin_id": bin_id,
+            "count": counts[bin_id],
+            "weight_g": weight_g,
+            "co2_saved_g": co2_saved_g
+        })
+
+    return json_response({
+        "ok": True,
+        "ts": ts,
+        "count": len(rows),
+        "weight_g": sum(acc[0] for acc in per_bin.values()),
+        "co2_saved_g": sum(acc[1] for acc in per_bin.values()),
+        "bins": bins
+    })
 
 
 # =========================
@@ -447,27 +1017,28 @@ def add_event(
 # =========================
 @app.get("/api/bins")
 def list_bins():
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT bin_id, capacity_g, current_weight_g, last_seen
-            FROM bins
-            ORDER BY bin_id
-        """).fetchall()
+    with get_conn(readonly=True) as conn:
+        return json_response(_bins_rows(conn))
 
-    out = []
-    for r in rows:
-        capacity = float(r["capacity_g"])
-        current = float(r["current_weight_g"])
-        fill_percent = 0.0 if capacity <= 0 else min(100.0, (current / capacity) * 100.0)
 
-        out.append({
-            "bin_id": r["bin_id"],
-            "capacity_g": capacity,
-            "current_weight_g": current,
+def _bins_rows(conn: DBConn) -> list[dict]:
+    rows = conn.fetch_tuples("""
+        SELECT bin_id, capacity_g, current_weight_g, :FILL_PERCENT AS fill_percent, last_seen
+        FROM bins
+        ORDER BY bin_id
+    """)
+
+    # colonne REAL / DOUBLE PRECISION e fill_percent calcolato dal DB: solo impacchettamento
+    return [
+        {
+            "bin_id": bin_id,
+            "capacity_g": capacity_g,
+            "current_weight_g": current_weight_g,
             "fill_percent": fill_percent,
-            "last_seen": r["last_seen"]
-        })
-    return out
+            "last_seen": last_seen
+        }
+        for bin_id, capacity_g, current_weight_g, fill_percent, last_seen in rows
+    ]
 
 
 # =========================
@@ -480,12 +1051,12 @@ def bin_detail(
     events_limit: int = 20,
     x_api_key: str | None = Header(default=None),
 ):
-    days = max(1, min(int(days), 365))
-    events_limit = max(1, min(int(events_limit), 200))
+    days = clamp_days(days)
+    events_limit = clamp_limit(events_limit)
 
-    with get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         b = conn.execute("""
-            SELECT bin_id, capacity_g, current_weight_g, last_seen
+            SELECT bin_id, capacity_g, current_weight_g, :FILL_PERCENT AS fill_percent, last_seen
             FROM bins
             WHERE bin_id=?
         """, (bin_id,)).fetchone()
@@ -493,48 +1064,31 @@ def bin_detail(
     if not b:
         raise HTTPException(status_code=404, detail="Bin non trovato")
 
-    capacity = float(b["capacity_g"])
-    current = float(b["current_weight_g"])
-    fill_percent = 0.0 if capacity <= 0 else min(100.0, (current / capacity) * 100.0)
-
     daily = compute_daily_for_bin(bin_id, days)
     mats = stats_by_material_for_bin(bin_id, days=days)  # defined below
 
     admin = is_admin(x_api_key)
     recent = []
     if admin:
-        with get_conn() as conn:
-            rows = conn.execute("""
-                SELECT id, ts, material, weight_g, co2_saved_g,
+        with get_conn(readonly=True) as conn:
+            rows = conn.fetch_tuples("""
+                SELECT id, :TS_ISO AS ts, bin_id, material, weight_g, co2_saved_g,
                        source, model_version, confidence, image_ref
                 FROM events
                 WHERE bin_id=?
                 ORDER BY id DESC
                 LIMIT ?
-            """, (bin_id, events_limit)).fetchall()
-
-        for r in rows:
-            recent.append({
-                "id": r["id"],
-                "ts": r["ts"],
-                "bin_id": bin_id,
-                "material": r["material"],
-                "weight_g": float(r["weight_g"]),
-                "co2_saved_g": float(r["co2_saved_g"]),
-                "source": r.get("source") if isinstance(r, dict) else r["source"],
-                "model_version": r.get("model_version") if isinstance(r, dict) else r["model_version"],
-                "confidence": (float(r["confidence"]) if r.get("confidence") is not None else None) if isinstance(r, dict)
-                              else (float(r["confidence"]) if r["confidence"] is not None else None),
-                "image_ref": r.get("image_ref") if isinstance(r, dict) else r["image_ref"],
-            })
+            """, (bin_id, events_limit))
 
-    return {
+        recent = _recent_dicts(rows)
+
+    return json_response({
         "ok": True,
         "bin": {
             "bin_id": b["bin_id"],
-            "capacity_g": capacity,
-            "current_weight_g": current,
-            "fill_percent": fill_percent,
+            "capacity_g": b["capacity_g"],
+            "current_weight_g": b["current_weight_g"],
+            "fill_percent": b["fill_percent"],
             "last_seen": b["last_seen"],
         },
         "days": days,
@@ -542,52 +1096,66 @@ def bin_detail(
         "daily": daily,
         "by_material": mats,
         "recent_events": recent,
-        "ts": datetime.now(timezone.utc).isoformat(),
-    }
+        "ts": _now_iso(),
+    })
 
 
 # =========================
 # API: statistiche totali (LIBERO)
 # =========================
 @app.get("/api/stats/total")
-def stats_total():
-    with get_conn() as conn:
+def stats_total(
+    if_none_match: str | None = Header(default=None),
+):
+    headers, not_modified = check_etag(data_etag("total"), if_none_match)
+    if not_modified is not None:
+        return not_modified
+
+    with get_conn(readonly=True) as conn:
+        # somma dei totali per materiale: poche righe invece dell'intero storico
         row = conn.execute("""
             SELECT
-              COALESCE(SUM(weight_g), 0) AS total_weight_g,
-              COALESCE(SUM(co2_saved_g), 0) AS total_co2_saved_g
-            FROM events
+              COALESCE(SUM(weight_g), 0.0) AS total_weight_g,
+              COALESCE(SUM(co2_saved_g), 0.0) AS total_co2_saved_g
+            FROM events_material
         """).fetchone()
 
-    return {
-        "total_weight_g": float(row["total_weight_g"]),
-        "total_co2_saved_g": float(row["total_co2_saved_g"])
-    }
+    return json_response({
+        "total_weight_g": row["total_weight_g"],
+        "total_co2_saved_g": row["total_co2_saved_g"]
+    }, headers)
 
 
 # =========================
 # API: report per materiale (LIBERO)
 # =========================
 @app.get("/api/stats/by_material")
-def stats_by_material():
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT
-              material,
-              COALESCE(SUM(weight_g), 0) AS weight_g,
-              COALESCE(SUM(co2_saved_g), 0) AS co2_saved_g
-            FROM events
-            GROUP BY material
-            ORDER BY weight_g DESC
-        """).fetchall()
+def stats_by_material(
+    if_none_match: str | None = Header(default=None),
+):
+    headers, not_modified = check_etag(data_etag("by_material"), if_none_match)
+    if not_modified is not None:
+        return not_modified
+
+    with get_conn(readonly=True) as conn:
+        return json_response(_materials_rows(conn), headers)
+
+
+def _materials_rows(conn: DBConn) -> list[dict]:
+    # da events_material: una riga per materiale, già aggregata
+    rows = conn.fetch_tuples("""
+        SELECT material, weight_g, co2_saved_g
+        FROM events_material
+        ORDER BY weight_g DESC
+    """)
+
+    return _material_dicts(rows)
 
+
+def _material_dicts(rows: list[tuple]) -> list[dict]:
     return [
-        {
-            "material": r["material"],
-            "weight_g": float(r["weight_g"]),
-            "co2_saved_g": float(r["co2_saved_g"]),
-        }
-        for r in rows
+        {"material": material, "weight_g": weight_g, "co2_saved_g": co2_saved_g}
+        for material, weight_g, co2_saved_g in rows
     ]
 
 
@@ -595,38 +1163,39 @@ def stats_by_material():
 # ✅ Helper: report per materiale (per-bin nel range)
 # =========================
 def stats_by_material_for_bin(bin_id: str, days: int) -> list[dict]:
-    days = max(1, min(int(days), 365))
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-    cutoff_iso = cutoff.isoformat()
+    days = clamp_days(days)
 
-    with get_conn() as conn:
-        rows = conn.execute("""
+    # stessa finestra a giorni UTC interi di compute_daily_for_bin: in bin_detail
+    # i totali per materiale e quelli della serie giornaliera coincidono
+    with get_conn(readonly=True) as conn:
+        rows = conn.fetch_tuples("""
             SELECT
               material,
-              COALESCE(SUM(weight_g), 0) AS weight_g,
-              COALESCE(SUM(co2_saved_g), 0) AS co2_saved_g
+              SUM(weight_g) AS weight_g,
+              SUM(co2_saved_g) AS co2_saved_g
             FROM events
-            WHERE ts >= ? AND bin_id = ?
+            WHERE ts >= :CUTOFF_TS AND bin_id = ?
             GROUP BY material
             ORDER BY weight_g DESC
-        """, (cutoff_iso, bin_id)).fetchall()
+        """, (days, bin_id))
 
-    return [
-        {
-            "material": r["material"],
-            "weight_g": float(r["weight_g"]),
-            "co2_saved_g": float(r["co2_saved_g"]),
-        }
-        for r in rows
-    ]
+    return _material_dicts(rows)
 
 
 # =========================
 # API: report giornaliero (LIBERO)
 # =========================
 @app.get("/api/stats/daily")
-def stats_daily(days: int = 30):
-    return compute_daily(days)
+def stats_daily(
+    days: int = 30,
+    if_none_match: str | None = Header(default=None),
+):
+    days = clamp_days(days)
+    headers, not_modified = check_etag(data_etag("daily", days), if_none_match)
+    if not_modified is not None:
+        return not_modified
+
+    return json_response(compute_daily(days), headers)
 
 
 # =========================
@@ -635,36 +1204,38 @@ def stats_daily(days: int = 30):
 @app.get("/api/events/recent")
 def recent_events(
     limit: int = 20,
-    x_api_key: str | None = Header(default=None),
+    _: None = AdminKey,
 ):
-    require_admin_key(x_api_key)
-    limit = max(1, min(int(limit), 200))
+    limit = clamp_limit(limit)
 
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT id, ts, bin_id, material, weight_g, co2_saved_g,
-                   source, model_version, confidence, image_ref
-            FROM events
-            ORDER BY id DESC
-            LIMIT ?
-        """, (limit,)).fetchall()
-
-    out = []
-    for r in rows:
-        out.append({
-            "id": r["id"],
-            "ts": r["ts"],
-            "bin_id": r["bin_id"],
-            "material": r["material"],
-            "weight_g": float(r["weight_g"]),
-            "co2_saved_g": float(r["co2_saved_g"]),
-            "source": r.get("source") if isinstance(r, dict) else r["source"],
-            "model_version": r.get("model_version") if isinstance(r, dict) else r["model_version"],
-            "confidence": (float(r["confidence"]) if r.get("confidence") is not None else None) if isinstance(r, dict)
-                          else (float(r["confidence"]) if r["confidence"] is not None else None),
-            "image_ref": r.get("image_ref") if isinstance(r, dict) else r["image_ref"],
-        })
-    return out
+    with get_conn(readonly=True) as conn:
+        return json_response(_recent_rows(conn, limit))
+
+
+def _recent_rows(conn: DBConn, limit: int) -> list[dict]:
+    rows = conn.fetch_tuples("""
+        SELECT id, :TS_ISO AS ts, bin_id, material, weight_g, co2_saved_g,
+               source, model_version, confidence, image_ref
+        FROM events
+        ORDER BY id DESC
+        LIMIT ?
+    """, (limit,))
+
+    return _recent_dicts(rows)
+
+
+def _recent_dicts(rows: list[tuple]) -> list[dict]:
+    # colonne già nella forma della risposta (ts come testo ISO): solo impacchettamento
+    return [
+        {
+            "id": id_, "ts": ts, "bin_id": bin_id, "material": material,
+            "weight_g": weight_g, "co2_saved_g": co2_saved_g,
+            "source": source, "model_version": model_version,
+            "confidence": confidence, "image_ref": image_ref,
+        }
+        for (id_, ts, bin_id, material, weight_g, co2_saved_g,
+             source, model_version, confidence, image_ref) in rows
+    ]
 
 
 # =========================
@@ -674,56 +1245,158 @@ def recent_events(
 def dashboard(
     days: int = 30,
     x_api_key: str | None = Header(default=None),
+    if_none_match: str | None = Header(default=None),
 ):
-    bins = list_bins()
-    totals = stats_total()
-    daily = stats_daily(days=days)
-    mats = stats_by_material()
-
+    days = clamp_days(days)
     admin = is_admin(x_api_key)
-    recent = []
-    if admin:
-        recent = recent_events(limit=20, x_api_key=x_api_key)
 
-    return {
+    # ETag letto prima delle query: una scrittura concorrente al più causa un 200 in più
+    headers, not_modified = check_etag(data_etag("dashboard", days, int(admin)), if_none_match)
+    if not_modified is not None:
+        return not_modified
+
+    # una sola connessione (e su SQLite un solo snapshot) per tutte le sezioni della dashboard
+    with get_conn(readonly=True) as conn, conn.read_snapshot():
+        bins = _bins_rows(conn)
+        mats = _materials_rows(conn)
+        daily = compute_daily(days, conn)
+        recent = _recent_rows(conn, 20) if admin else []
+
+    # totali = somma dei subtotali per materiale già letti: nessuna query in più
+    totals = {
+        "total_weight_g": sum((m["weight_g"] for m in mats), 0.0),
+        "total_co2_saved_g": sum((m["co2_saved_g"] for m in mats), 0.0),
+    }
+
+    return json_response({
         "ok": True,
-        "days": max(1, min(int(days), 365)),
+        "days": days,
         "is_admin": admin,
         "totals": totals,
         "bins": bins,
         "daily": daily,
         "by_material": mats,
         "recent_events": recent,
-        "ts": datetime.now(timezone.utc).isoformat()
-    }
+        "ts": _now_iso()
+    }, headers)
 
 
 # =========================
 # Export CSV eventi (ADMIN)
 # =========================
-@app.get("/api/export/events.csv")
-def export_events_csv(
-    x_api_key: str | None = Header(default=None),
-):
-    require_admin_key(x_api_key)
-
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT ts, bin_id, material, weight_g, co2_saved_g
+# righe per blocco inviato al client durante l'export in streaming (~50 KB)
+EXPORT_CHUNK_ROWS = 1000
+# livello 1: il CSV è molto ripetitivo, quasi tutta la compressione al costo minimo di CPU
+EXPORT_GZIP_LEVEL = 1
+# header fissi preformattati una volta (terminatore \r\n come csv.writer per il corpo)
+_EVENTS_CSV_HEADER = "ts,bin_id,material,weight_g,co2_saved_g\r\n"
+_DAILY_CSV_HEADER = "day,total_weight_g,total_co2_saved_g\r\n"
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    # q-value di ogni codifica (RFC 9110): "gzip" esplicito vince su "*", accettato se q > 0
+    q_by_coding: dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, *params = part.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        q_by_coding[coding] = q
+    q = q_by_coding.get("gzip", q_by_coding.get("*", 0.0))
+    return q > 0
+
+
+def _gzip_chunks(chunks):
+    # gzip in streaming sui blocchi CSV già batchati (wbits=31 -> header/trailer gzip):
+    # una compress() per chunk, non per riga, e la compressione procede insieme alle letture
+    z = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)
+    with contextlib.closing(chunks):
+        for chunk in chunks:
+            out = z.compress(chunk.encode("utf-8"))
+            if out:
+                yield out
+    yield z.flush()
+
+
+# export in streaming contemporanei: ognuno tiene una connessione per tutto il download
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+def _events_csv_chunks(conn: DBConn):
+    # CSV a blocchi: in memoria resta al massimo un chunk, il primo byte parte subito.
+    # conn (get_export_conn, fuori dal pool dei lettori) e slot export rilasciati nel finally
+    try:
+        yield _EVENTS_CSV_HEADER
+        buf = io.StringIO()
+        w = csv.writer(buf)
+
+        # closing(): se il client si disconnette a metà, lo stream (cursore named e
+        # transazione su Postgres) si chiude prima di restituire la connessione
+        with contextlib.closing(conn.stream("""
+            SELECT :TS_ISO AS ts, bin_id, material, weight_g, co2_saved_g
             FROM events
-            ORDER BY ts ASC
-        """).fetchall()
+            ORDER BY events.ts ASC
+        """, tuples=True)) as rows:
+            # tuple già nell'ordine delle colonne CSV, ts già testo ISO (:TS_ISO):
+            # writerows (C) le consuma senza lookup per nome né conversioni per riga
+            while True:
+                buf.seek(0)
+                buf.truncate()
+                w.writerows(itertools.islice(rows, EXPORT_CHUNK_ROWS))
+                chunk = buf.getvalue()
+                if not chunk:
+                    return
+                yield chunk
+    finally:
+        conn.close()
+        _export_slots.release()
 
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["ts", "bin_id", "material", "weight_g", "co2_saved_g"])
-    for r in rows:
-        w.writerow([r["ts"], r["bin_id"], r["material"], r["weight_g"], r["co2_saved_g"]])
 
-    return Response(
-        content=buf.getvalue(),
+def _primed(chunks):
+    # avvia il generatore fino al primo chunk: da lì il suo finally gira sempre (fine,
+    # disconnessione o garbage collection di una risposta mai iterata)
+    first = next(chunks)
+
+    def gen():
+        with contextlib.closing(chunks):
+            yield first
+            yield from chunks
+
+    return gen()
+
+
+@app.get("/api/export/events.csv")
+def export_events_csv(
+    _: None = AdminKey,
+    accept_encoding: str | None = Header(default=None),
+):
+    # slot esauriti -> 503 subito, invece di accodare altri download lunghi
+    if not _export_slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Troppi export in corso, riprova più tardi")
+    try:
+        conn = get_export_conn()
+    except BaseException:
+        _export_slots.release()
+        raise
+
+    chunks = _primed(_events_csv_chunks(conn))
+    headers = {"Content-Disposition": "attachment; filename=sorti_events.csv", "Vary": "Accept-Encoding"}
+    if accepts_gzip(accept_encoding):
+        chunks = _gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(
+        chunks,
         media_type="text/csv; charset=utf-8",
-        headers={"Content-Disposition": "attachment; filename=sorti_events.csv"},
+        headers=headers,
     )
 
 
@@ -733,22 +1406,38 @@ def export_events_csv(
 @app.get("/api/export/daily.csv")
 def export_daily_csv(
     days: int = 30,
-    x_api_key: str | None = Header(default=None),
+    _: None = AdminKey,
+    if_none_match: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
 ):
-    require_admin_key(x_api_key)
+    days = clamp_days(days)
+    gz = accepts_gzip(accept_encoding)
+
+    # stessa versione dati di /api/stats/daily: export ripetuti senza ingest nel frattempo -> 304.
+    # ETag distinto per la variante gzip (byte diversi = entità diversa)
+    headers, not_modified = check_etag(data_etag("daily_csv", days, "gz" if gz else "id"), if_none_match)
+    headers["Vary"] = "Accept-Encoding"
+    if not_modified is not None:
+        return Response(status_code=304, headers=headers)
+
     rows = compute_daily(days)
 
-    buf = io.StringIO()
+    buf = io.StringIO(_DAILY_CSV_HEADER)
+    buf.seek(0, io.SEEK_END)
     w = csv.writer(buf)
-    w.writerow(["day", "total_weight_g", "total_co2_saved_g"])
-    for r in rows:
-        w.writerow([r["day"], r["weight_g"], r["co2_saved_g"]])
+    # <= 365 righe già in cache: buffer unico, niente streaming
+    w.writerows((r["day"], r["weight_g"], r["co2_saved_g"]) for r in rows)
+
+    body = buf.getvalue().encode("utf-8")
+    if gz:
+        body = zlib.compress(body, EXPORT_GZIP_LEVEL, 31)
+        headers["Content-Encoding"] = "gzip"
 
-    d = max(1, min(int(days), 365))
+    headers["Content-Disposition"] = f"attachment; filename=sorti_daily_{days}d.csv"
     return Response(
-        content=buf.getvalue(),
+        content=body,
         media_type="text/csv; charset=utf-8",
-        headers={"Content-Disposition": f"attachment; filename=sorti_daily_{d}d.csv"},
+        headers=headers,
     )
 
 
@@ -758,25 +1447,19 @@ def export_daily_csv(
 @app.post("/api/bins/{bin_id}/empty")
 def empty_bin(
     bin_id: str,
-    x_api_key: str | None = Header(default=None),
+    _: None = AdminKey,
 ):
-    require_admin_key(x_api_key)
-
-    now = datetime.now(timezone.utc).isoformat()
-
     with get_conn() as conn:
-        exists = conn.execute(
-            "SELECT bin_id FROM bins WHERE bin_id=?",
+        # nessuna riga aggiornata = bin inesistente: niente SELECT di esistenza separata
+        row = conn.execute(
+            "UPDATE bins SET current_weight_g=0, last_seen=:NOW WHERE bin_id=? RETURNING last_seen",
             (bin_id,)
         ).fetchone()
 
-        if not exists:
-            raise HTTPException(status_code=404, detail="Bin non trovato")
-
-        conn.execute(
-            "UPDATE bins SET current_weight_g=0, last_seen=? WHERE bin_id=?",
-            (now, bin_id)
-        )
+    if not row:
+        raise HTTPException(status_code=404, detail="Bin non trovato")
+    now = row["last_seen"]
+    bump_data_version()
 
     # 🔔 notify realtime
     sse_publish("update", {"type": "empty", "bin_id": bin_id, "ts": now})
@@ -784,6 +1467,32 @@ def empty_bin(
     return {"ok": True, "bin_id": bin_id, "emptied_at": now}
 
 
+# =========================
+# Ricarica fattori CO2 (ADMIN)
+# =========================
+@app.post("/api/admin/reload_factors")
+def admin_reload_factors(
+    _: None = AdminKey,
+):
+    factors = reload_factors()
+    return {"ok": True, "materials": sorted(factors)}
+
+
+# =========================
+# Ricostruisci aggregati giornaliero / per materiale (ADMIN)
+# =========================
+@app.post("/api/admin/rebuild_daily")
+def rebuild_daily(
+    _: None = AdminKey,
+):
+    # per eventi inseriti/corretti direttamente nel DB, fuori da /api/event
+    rebuild_aggregates()
+    invalidate_daily_cache()
+    bump_data_version()
+
+    return {"ok": True}
+
+
 
 
 